@@ -1,10 +1,7 @@
 from __future__ import absolute_import
 
-import craft_text_detector.craft_utils as craft_utils
-import craft_text_detector.file_utils as file_utils
-import craft_text_detector.image_utils as image_utils
-import craft_text_detector.predict as predict
-import craft_text_detector.torch_utils as torch_utils
+import importlib
+import sys
 
 __version__ = "0.3.1"
 
@@ -20,13 +17,37 @@ __all__ = [
     "Craft",
 ]
 
-read_image = image_utils.read_image
-load_craftnet_model = craft_utils.load_craftnet_model
-load_refinenet_model = craft_utils.load_refinenet_model
-get_prediction = predict.get_prediction
-export_detected_regions = file_utils.export_detected_regions
-export_extra_results = file_utils.export_extra_results
-empty_cuda_cache = torch_utils.empty_cuda_cache
+# submodules and the helpers re-exported from them, they are imported on first
+# access so that e.g. craft_utils post-processing does not pull in torch and gdown
+_SUBMODULES = ["craft_utils", "file_utils", "image_utils", "predict", "torch_utils"]
+_HELPERS = {
+    "read_image": "image_utils",
+    "load_craftnet_model": "craft_utils",
+    "load_refinenet_model": "craft_utils",
+    "get_prediction": "predict",
+    "export_detected_regions": "file_utils",
+    "export_extra_results": "file_utils",
+    "empty_cuda_cache": "torch_utils",
+}
+
+
+def _load(name):
+    if name in _SUBMODULES:
+        return importlib.import_module("craft_text_detector." + name)
+    return getattr(_load(_HELPERS[name]), name)
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name not in _SUBMODULES and name not in _HELPERS:
+            raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+        value = _load(name)
+        globals()[name] = value
+        return value
+else:
+    # module level __getattr__ needs python>=3.7, import everything upfront
+    for _name in _SUBMODULES + list(_HELPERS):
+        globals()[_name] = _load(_name)
 
 
 class Craft:
@@ -80,18 +101,24 @@ class Craft:
         """
         Loads craftnet model
         """
+        from craft_text_detector.craft_utils import load_craftnet_model
+
         self.craft_net = load_craftnet_model(self.cuda)
 
     def load_refinenet_model(self):
         """
         Loads refinenet model
         """
+        from craft_text_detector.craft_utils import load_refinenet_model
+
         self.refine_net = load_refinenet_model(self.cuda)
 
     def unload_craftnet_model(self):
         """
         Unloads craftnet model
         """
+        from craft_text_detector.torch_utils import empty_cuda_cache
+
         self.craft_net = None
         empty_cuda_cache()
 
@@ -99,6 +126,8 @@ class Craft:
         """
         Unloads refinenet model
         """
+        from craft_text_detector.torch_utils import empty_cuda_cache
+
         self.refine_net = None
         empty_cuda_cache()
 
@@ -115,6 +144,13 @@ class Craft:
             "text_crop_paths": list of paths of the exported text boxes/polys,
             "times": elapsed times of the sub modules, in seconds}
         """
+        from craft_text_detector.file_utils import (
+            export_detected_regions,
+            export_extra_results,
+        )
+        from craft_text_detector.image_utils import read_image
+        from craft_text_detector.predict import get_prediction
+
         # load image
         image = read_image(image_path)
 
@@ -1,39 +1,84 @@
 import math
 import os
-from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from itertools import permutations
-import math
 
 import cv2
 import numpy as np
-from numpy.core.fromnumeric import amin
-
-import craft_text_detector.file_utils as file_utils
-import craft_text_detector.torch_utils as torch_utils
 
 CRAFT_GDRIVE_URL = "https://drive.google.com/uc?id=1bupFXqT-VU6Jjeul13XP7yx2Sg5IHr4J"
 REFINENET_GDRIVE_URL = (
     "https://drive.google.com/uc?id=1xcE9qpJXp4ofINwXWVhhQIh9S8Z7cuGj"
 )
 
+# fastest 4-connectivity labelling algorithm of the installed opencv,
+# Spaghetti is only shipped with opencv>=4.5
+CCL_TYPE = cv2.CCL_SPAGHETTI if hasattr(cv2, "CCL_SPAGHETTI") else cv2.CCL_SAUF
+
+# rectangular dilation kernels of getDetBoxes_core, keyed by niter
+DILATION_KERNELS = {}
+
+# threads shared by all getDetBoxes_core calls to process the labels of a page, they
+# are only started on first use and only for pages with at least MIN_PARALLEL_LABELS
+LABEL_WORKERS = min(4, os.cpu_count() or 1)
+LABEL_EXECUTOR = ThreadPoolExecutor(max_workers=LABEL_WORKERS)
+MIN_PARALLEL_LABELS = 256
+
+
+# unwarp corodinates, pts is a single (x, y) point or a NX2 array of them
+def warpCoord(Minv, pts):
+    pts = np.asarray(pts, dtype=np.float64)
+    out = np.concatenate((pts, np.ones(pts.shape[:-1] + (1,))), axis=-1) @ Minv.T
+    return out[..., :2] / out[..., 2:]
 
-# unwarp corodinates
-def warpCoord(Minv, pt):
-    out = np.matmul(Minv, (pt[0], pt[1], 1))
-    return np.array([out[0] / out[2], out[1] / out[2]])
+
+# invert a 3X3 perspective transform, raises ZeroDivisionError if it is singular
+def invertHomography(M):
+    a, b, c, d, e, f, g, h, i = M.ravel().tolist()
+    ei_fh, di_fg, dh_eg = e * i - f * h, d * i - f * g, d * h - e * g
+    inv_det = 1.0 / (a * ei_fh - b * di_fg + c * dh_eg)
+    return np.array([
+        [ei_fh, c * h - b * i, b * f - c * e],
+        [-di_fg, a * i - c * g, c * d - a * f],
+        [dh_eg, b * g - a * h, a * e - b * d],
+    ]) * inv_det
+
+
+def lineOverlaps(mask, pt1, pt2):
+    '''
+    Returns True if the 1 pixel thick line drawn from pt1 to pt2 touches
+    a nonzero pixel of mask. Only the bounding box of the line is rasterized.
+    Args:
+        mask (np.ndarray): a 2d np array
+        pt1 (tuple): (x,y) integer start point of the line
+        pt2 (tuple): (x,y) integer end point of the line
+    '''
+    h, w = mask.shape
+    # clip to the mask the same way cv2.line clips to the image it draws on
+    inside, pt1, pt2 = cv2.clipLine((0, 0, w, h), pt1, pt2)
+    if not inside:
+        return False
+    sx, ex = min(pt1[0], pt2[0]), max(pt1[0], pt2[0]) + 1
+    sy, ey = min(pt1[1], pt2[1]), max(pt1[1], pt2[1]) + 1
+    line_img = np.zeros((ey - sy, ex - sx), dtype=np.uint8)
+    cv2.line(
+        line_img,
+        (pt1[0] - sx, pt1[1] - sy),
+        (pt2[0] - sx, pt2[1] - sy),
+        1,
+        thickness=1,
+    )
+    return bool(np.logical_and(mask[sy:ey, sx:ex], line_img).any())
 
 
 def copyStateDict(state_dict):
-    if list(state_dict.keys())[0].startswith("module"):
-        start_idx = 1
+    # strip the "module." prefix DataParallel adds to the weight names
+    if next(iter(state_dict)).startswith("module."):
+        prefix_len = len("module.")
     else:
-        start_idx = 0
-    new_state_dict = OrderedDict()
-    for k, v in state_dict.items():
-        name = ".".join(k.split(".")[start_idx:])
-        new_state_dict[name] = v
-    return new_state_dict
+        prefix_len = 0
+    return {k[prefix_len:]: v for k, v in state_dict.items()}
 
 
 def load_craftnet_model(cuda: bool = False):
@@ -51,6 +96,8 @@ def load_craftnet_model(cuda: bool = False):
         home_path, ".craft_text_detector", "weights", "craft_mlt_25k.pth"
     )
     # load craft net
+    import craft_text_detector.file_utils as file_utils
+    import craft_text_detector.torch_utils as torch_utils
     from craft_text_detector.models.craftnet import CraftNet
 
     craft_net = CraftNet()  # initialize
@@ -93,6 +140,8 @@ def load_refinenet_model(cuda: bool = False):
         home_path, ".craft_text_detector", "weights", "craft_refiner_CTW1500.pth"
     )
     # load refine net
+    import craft_text_detector.file_utils as file_utils
+    import craft_text_detector.torch_utils as torch_utils
     from craft_text_detector.models.refinenet import RefineNet
 
     refine_net = RefineNet()  # initialize
@@ -139,45 +188,63 @@ def getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text)
             multiline text element, equal to the next line text crop index when it has one.
         
     '''
-    def compare_boxes(box1, box2, slope_thresh = 0.1, min_edge_distance = 10):
+    def compare_boxes(boxes, slope_thresh = 0.1, min_edge_distance = 10):
         '''
-        Given 2 4X2 numpy array containing [[x,y]..] points
-        Returns True if they are next to each other else False
+        Given a NX4X2 numpy array containing N boxes of [[x,y]..] points
+        Returns a NXN boolean adjacency matrix whose [i, j] element is True when
+        box i lies on top of and next to box j
         Args:
-            box1 (np.ndarray): a 4X2 nummy float32 array containing the 4 coordinates in 
-                TL->TR->BR->BL sequence in (x,y) order, This box is assumed to be the one on top.
-            box2 (np.ndarray): a 4X2 nummy float32 array containing the 4 coordinates in 
-                TL->TR->BR->BL sequence in (x,y) order, This box is assumed to be the one at the bottom.
+            boxes (np.ndarray): a NX4X2 nummy float32 array containing for each box the 4
+                coordinates in TL->TR->BR->BL sequence in (x,y) order
             slope_thresh (float): minimum difference between any 2 edges to be considered parallell
             min_edge_distance (float): minimum distance between the mid points of any 2 edges to be
                 considered adjacent/overlapping/"intersecting"
             
         '''
-        boxcentroid1 = np.mean(box1, axis=0)
-        boxcentroid2 = np.mean(box2, axis=0)
-        
-        # check if box1 is above box2 spatially
-        if boxcentroid1[1] < boxcentroid2[1]:
-            for i, j in permutations(range(4), 2):
-                for k,l in permutations(range(4), 2):
-                    # compute slope and mid points of any 2 edges
-                    #  and compare their differences 
-                    slope1 = (box1[i, 1]-box1[j, 1])/(box2[i, 0]-box2[j, 0]\
-                        if (box2[i, 0]-box2[j, 0]) != 0 else 0.001)
-                    slope2 = (box1[k, 1]-box1[l, 1])/(box2[k, 0]-box2[l, 0]\
-                        if (box2[k, 0]-box2[l, 0]) != 0 else 0.001)
-                    
-                    linecentroid1 = (box1[i,:] + box1[j,:])/2
-                    linecentroid2 = (box2[j,:] + box2[k,:])/2
-                        
-                    if abs(slope1 - slope2) < slope_thresh and\
-                        np.sum(abs((linecentroid1 - linecentroid2))) < min_edge_distance:
-                        return True
-        else:
-            return False
+        # vertex indices of the 12 ordered edges (i, j) of a box
+        edge_i, edge_j = np.array(list(permutations(range(4), 2))).T
+
+        # check if box1 is above box2 spatially, only those pairs are compared further
+        boxcentroids = boxes.mean(axis=1)
+        candidates = boxcentroids[:, None, 1] < boxcentroids[None, :, 1]
+
+        # the edge mid points of each box lie within its axis aligned bounding box, so
+        # pairs whose bounding boxes are min_edge_distance apart on an axis can not match
+        mins, maxs = boxes.min(axis=1), boxes.max(axis=1)
+        for axis in range(2):
+            candidates &= mins[None, :, axis] - maxs[:, None, axis] < min_edge_distance
+            candidates &= mins[:, None, axis] - maxs[None, :, axis] < min_edge_distance
+        top, bottom = np.nonzero(candidates)
+
+        adjacency = np.zeros((len(boxes), len(boxes)), dtype=bool)
+        # compare the remaining pairs in chunks to bound the memory of the 12X12 edge tests
+        for start in range(0, len(top), 1024):
+            box1 = boxes[top[start:start + 1024]]
+            box2 = boxes[bottom[start:start + 1024]]
+
+            # slope of every edge, rise taken from box1 and run taken from box2
+            rise = box1[:, edge_i, 1] - box1[:, edge_j, 1]
+            run = box2[:, edge_i, 0] - box2[:, edge_j, 0]
+            run = np.where(run != 0, run, boxes.dtype.type(0.001))
+            slopes = rise / run
+            parallel = np.abs(slopes[:, :, None] - slopes[:, None, :]) < slope_thresh
+
+            # mid points of the edges (i, j) of box1 and (j, k) of box2
+            linecentroids1 = (box1[:, edge_i] + box1[:, edge_j]) / 2
+            linecentroids2 = (box2[:, edge_j, None] + box2[:, None, edge_i]) / 2
+            dx = np.abs(linecentroids1[:, :, None, 0] - linecentroids2[..., 0])
+            dy = np.abs(linecentroids1[:, :, None, 1] - linecentroids2[..., 1])
+            close = dx + dy < min_edge_distance
+
+            adjacency[top[start:start + 1024], bottom[start:start + 1024]] = (
+                parallel & close).any(axis=(1, 2))
+        return adjacency
     
     def d(cord1, cord2):
-        return np.linalg.norm(cord1-cord2)
+        # squared distance, enough to compare edge lengths
+        dx = cord1[0] - cord2[0]
+        dy = cord1[1] - cord2[1]
+        return dx * dx + dy * dy
 
     def sort_box(box):
         '''
@@ -189,61 +256,47 @@ def getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text)
             a 4X2 np float32 array with the coordinates sorted in
             TL->TR->BR->BL sequence
         '''
-        aymin = np.argmin(box[:,1])
-        tl=0 
-        if d(box[aymin,:], box[(aymin+1)%4,:]) > d(box[(aymin+2)%4, :], box[(aymin+1)%4,:]):
+        aymin = int(box[:,1].argmin())
+        pts = box.tolist()
+        if d(pts[aymin], pts[(aymin+1)%4]) > d(pts[(aymin+2)%4], pts[(aymin+1)%4]):
             # aymin is top left
-            tl = np.argmin(box[:,1])
+            tl = aymin
         else:
-            tl = (np.argmin(box[:,1]) -1)%4
             # axmin is top right
-        box = box[tl:,:].tolist() + box[:tl,:].tolist()
-        return np.array(box).astype(np.float32)
+            tl = (aymin - 1)%4
+        return np.roll(box, -tl, axis=0)
 
-    # prepare data
-    linkmap = linkmap.copy()
-    textmap = textmap.copy()
+    # prepare data, the maps are only read so they are copied only when they are
+    # strided views (e.g. channels sliced out of the network output)
+    linkmap = np.ascontiguousarray(linkmap)
+    textmap = np.ascontiguousarray(textmap)
     img_h, img_w = textmap.shape
 
     """ labeling method """
-    ret, text_score = cv2.threshold(textmap, low_text, 1, 0)
-    ret, link_score = cv2.threshold(linkmap, link_threshold, 1, 0)
-
-    text_score_comb = np.clip(text_score + link_score, 0, 1)
-    nLabels, labels, stats, centroids = cv2.connectedComponentsWithStats(
-        text_score_comb.astype(np.uint8), connectivity=4)
-
-    det = []
-    mapper = []
-    num_characters = []
-    avg_character_sizes = []
-    for k in range(1, nLabels):
-        # size filtering
-        size = stats[k, cv2.CC_STAT_AREA]
-        if size < 10:
-            continue
+    # binary uint8 (0/255) score maps
+    text_score = cv2.compare(textmap, low_text, cv2.CMP_GT)
+    link_score = cv2.compare(linkmap, link_threshold, cv2.CMP_GT)
 
-        # thresholding
-        if np.max(textmap[labels == k]) < text_threshold:
-            continue
+    text_score_comb = cv2.bitwise_or(text_score, link_score)
+    nLabels, labels, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(
+        text_score_comb, 4, cv2.CV_32S, CCL_TYPE)
 
-        # make segmentation map
-        segmap = np.zeros(textmap.shape, dtype=np.uint8)
-        segmap[labels == k] = 255
+    # everything but the link pixels which are not text, i.e. not (link and not text)
+    non_link_area = cv2.bitwise_or(text_score, cv2.bitwise_not(link_score))
 
-        # remove link area
-        segmap[np.logical_and(link_score == 1, text_score == 0)] = 0
-        
-        # count number of characters in word segementation
-        word_chars, word_label, word_stats, word_centroid = cv2.connectedComponentsWithStats(
-            segmap.astype(np.uint8), connectivity=4)
-        num_characters.append(word_chars)
+    def process_label(k):
+        '''
+        Returns the (box, label, number of characters, average character size)
+        of the word segmentation with label k, None if it is filtered out
+        '''
+        # size filtering
+        size = stats[k, cv2.CC_STAT_AREA]
+        if size < 10:
+            return None
 
-        avg_character_size = np.mean(word_stats[:, 4])
-        avg_character_sizes.append(avg_character_size)
-        
         x, y = stats[k, cv2.CC_STAT_LEFT], stats[k, cv2.CC_STAT_TOP]
         w, h = stats[k, cv2.CC_STAT_WIDTH], stats[k, cv2.CC_STAT_HEIGHT]
+
         niter = int(math.sqrt(size * min(w, h) / (w * h)) * 2)
         sx, ex, sy, ey = (x - niter, x + w + niter + 1, y - niter, y + h + niter + 1)
         # boundary check
@@ -255,12 +308,39 @@ def getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text)
             ex = img_w
         if ey >= img_h:
             ey = img_h
-        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1 + niter, 1 + niter))
-        segmap[sy:ey, sx:ex] = cv2.dilate(segmap[sy:ey, sx:ex], kernel)
+
+        # make segmentation map, restricted to the dilated bounding box of the label
+        segmap = cv2.compare(labels[sy:ey, sx:ex], k, cv2.CMP_EQ)
+
+        # thresholding, the label mask is reused to find its maximum text score
+        max_score = cv2.minMaxLoc(
+            textmap[y:y + h, x:x + w], mask=segmap[y - sy:y - sy + h, x - sx:x - sx + w])[1]
+        if max_score < text_threshold:
+            return None
+
+        # remove link area
+        segmap = cv2.bitwise_and(segmap, non_link_area[sy:ey, sx:ex], dst=segmap)
+        
+        # count number of characters in word segementation
+        word_chars, word_label, word_stats, word_centroid = cv2.connectedComponentsWithStatsWithAlgorithm(
+            segmap, 4, cv2.CV_32S, CCL_TYPE)
+
+        # the background label spans the whole image, not only the segmentation map
+        word_stats[0, cv2.CC_STAT_AREA] += img_h * img_w - segmap.size
+        avg_character_size = np.mean(word_stats[:, 4])
+        
+        # a 1x1 kernel leaves the map unchanged
+        if niter > 0:
+            if niter not in DILATION_KERNELS:
+                DILATION_KERNELS[niter] = cv2.getStructuringElement(
+                    cv2.MORPH_RECT, (1 + niter, 1 + niter))
+            segmap = cv2.dilate(segmap, DILATION_KERNELS[niter])
 
         # make box
-        np_temp = np.roll(np.array(np.where(segmap != 0)), 1, axis=0)
-        np_contours = np_temp.transpose().reshape(-1, 2)
+        ys, xs = np.nonzero(segmap)
+        xs += sx
+        ys += sy
+        np_contours = np.stack([xs, ys], axis=1).astype(np.int32)
         rectangle = cv2.minAreaRect(np_contours)
         box = cv2.boxPoints(rectangle)
 
@@ -268,8 +348,8 @@ def getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text)
         w, h = np.linalg.norm(box[0] - box[1]), np.linalg.norm(box[1] - box[2])
         box_ratio = max(w, h) / (min(w, h) + 1e-5)
         if abs(1 - box_ratio) <= 0.1:
-            l, r = min(np_contours[:, 0]), max(np_contours[:, 0])
-            t, b = min(np_contours[:, 1]), max(np_contours[:, 1])
+            l, r = xs.min(), xs.max()
+            t, b = ys.min(), ys.max()
             box = np.array([[l, t], [r, t], [r, b], [l, b]], dtype=np.float32)
 
         # make clock-wise order
@@ -277,17 +357,27 @@ def getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text)
         box = np.roll(box, 4 - startidx, 0)
         box = np.array(box)
 
-        det.append(sort_box(box))
-        mapper.append(k)
+        return sort_box(box), k, word_chars, avg_character_size
+
+    # labels are independent and opencv releases the GIL, so pages with many labels
+    # are processed in parallel, few labels do not pay for the thread hand-off
+    if LABEL_WORKERS > 1 and nLabels - 1 >= MIN_PARALLEL_LABELS:
+        results = LABEL_EXECUTOR.map(process_label, range(1, nLabels))
+    else:
+        results = map(process_label, range(1, nLabels))
+    results = [r for r in results if r is not None]
+
+    det = [r[0] for r in results]
+    mapper = [r[1] for r in results]
+    num_characters = [r[2] for r in results]
+    avg_character_sizes = [r[3] for r in results]
 
     word_id = [-1]*len(det)
-    for id1, (box1, size1) in enumerate(zip(det, avg_character_sizes)):
-        for id2, (box2, size2) in enumerate(zip(det, avg_character_sizes)):
-            if id1 == id2:
-                pass
-            else:
-                if compare_boxes(box1, box2):
-                    word_id[id1] = id2
+    if len(det) > 0:
+        adjacency = compare_boxes(np.stack(det))
+        # keep the last adjacent box of each row
+        last_adjacent = len(det) - 1 - adjacency[:, ::-1].argmax(axis=1)
+        word_id = np.where(adjacency.any(axis=1), last_adjacent, -1).tolist()
     return det, labels, mapper, num_characters, avg_character_sizes, word_id
 
 
@@ -315,7 +405,7 @@ def getPoly_core(boxes, labels, mapper, linkmap):
         M = cv2.getPerspectiveTransform(box, tar)
         word_label = cv2.warpPerspective(labels, M, (w, h), flags=cv2.INTER_NEAREST)
         try:
-            Minv = np.linalg.inv(M)
+            Minv = invertHomography(M)
         except:
             polys.append(None)
             continue
@@ -327,16 +417,12 @@ def getPoly_core(boxes, labels, mapper, linkmap):
 
         """ Polygon generation """
         # find top/bottom contours
-        cp = []
-        max_len = -1
-        for i in range(w):
-            region = np.where(word_label[:, i] != 0)[0]
-            if len(region) < 2:
-                continue
-            cp.append((i, region[0], region[-1]))
-            length = region[-1] - region[0] + 1
-            if length > max_len:
-                max_len = length
+        word_mask = word_label != 0
+        columns = np.flatnonzero(np.count_nonzero(word_mask, axis=0) >= 2)
+        tops = word_mask[:, columns].argmax(axis=0)
+        bottoms = h - 1 - word_mask[::-1, columns].argmax(axis=0)
+        cp = list(zip(columns.tolist(), tops.tolist(), bottoms.tolist()))
+        max_len = int((bottoms - tops).max()) + 1 if len(cp) > 0 else -1
 
         # pass if max_len is similar to h
         if h * max_len_ratio < max_len:
@@ -421,35 +507,19 @@ def getPoly_core(boxes, labels, mapper, linkmap):
         for r in np.arange(0.5, max_r, step_r):
             dx = 2 * half_char_h * r
             if not isSppFound:
-                line_img = np.zeros(word_label.shape, dtype=np.uint8)
                 dy = grad_s * dx
                 p = np.array(new_pp[0]) - np.array([dx, dy, dx, dy])
-                cv2.line(
-                    line_img,
-                    (int(p[0]), int(p[1])),
-                    (int(p[2]), int(p[3])),
-                    1,
-                    thickness=1,
-                )
                 if (
-                    np.sum(np.logical_and(word_label, line_img)) == 0
+                    not lineOverlaps(word_mask, (int(p[0]), int(p[1])), (int(p[2]), int(p[3])))
                     or r + 2 * step_r >= max_r
                 ):
                     spp = p
                     isSppFound = True
             if not isEppFound:
-                line_img = np.zeros(word_label.shape, dtype=np.uint8)
                 dy = grad_e * dx
                 p = np.array(new_pp[-1]) + np.array([dx, dy, dx, dy])
-                cv2.line(
-                    line_img,
-                    (int(p[0]), int(p[1])),
-                    (int(p[2]), int(p[3])),
-                    1,
-                    thickness=1,
-                )
                 if (
-                    np.sum(np.logical_and(word_label, line_img)) == 0
+                    not lineOverlaps(word_mask, (int(p[0]), int(p[1])), (int(p[2]), int(p[3])))
                     or r + 2 * step_r >= max_r
                 ):
                     epp = p
@@ -463,18 +533,17 @@ def getPoly_core(boxes, labels, mapper, linkmap):
             continue
 
         # make final polygon
-        poly = []
-        poly.append(warpCoord(Minv, (spp[0], spp[1])))
-        for p in new_pp:
-            poly.append(warpCoord(Minv, (p[0], p[1])))
-        poly.append(warpCoord(Minv, (epp[0], epp[1])))
-        poly.append(warpCoord(Minv, (epp[2], epp[3])))
-        for p in reversed(new_pp):
-            poly.append(warpCoord(Minv, (p[2], p[3])))
-        poly.append(warpCoord(Minv, (spp[2], spp[3])))
+        new_pp = np.array(new_pp)
+        poly = np.concatenate((
+            [spp[0:2]],
+            new_pp[:, 0:2],
+            [epp[0:2], epp[2:4]],
+            new_pp[::-1, 2:4],
+            [spp[2:4]],
+        ))
 
         # add to final result
-        polys.append(np.array(poly))
+        polys.append(warpCoord(Minv, poly))
 
     return polys
 
@@ -505,9 +574,6 @@ def getDetBoxes(textmap, linkmap, text_threshold, link_threshold, low_text, poly
 
 
 def adjustResultCoordinates(polys, ratio_w, ratio_h, ratio_net=2):
-    if len(polys) > 0:
-        polys = np.array(polys)
-        for k in range(len(polys)):
-            if polys[k] is not None:
-                polys[k] *= (ratio_w * ratio_net, ratio_h * ratio_net)
-    return polys
+    # polys may hold None entries and arrays of different lengths
+    scale = (ratio_w * ratio_net, ratio_h * ratio_net)
+    return [None if poly is None else np.multiply(poly, scale, dtype=poly.dtype) for poly in polys]
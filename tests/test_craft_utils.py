@@ -0,0 +1,94 @@
+import unittest
+
+import cv2
+import numpy as np
+
+from craft_text_detector.craft_utils import (
+    getDetBoxes,
+    invertHomography,
+    lineOverlaps,
+)
+
+
+def make_score_maps(second_line_left=20):
+    # two 3 character words, the second one 14px below the first
+    textmap = np.zeros((80, 120), dtype=np.float32)
+    linkmap = np.zeros((80, 120), dtype=np.float32)
+    for top, left in ((20, 20), (34, second_line_left)):
+        for char_left in (left, left + 12, left + 24):
+            textmap[top:top + 10, char_left:char_left + 8] = 0.9
+        for link_left in (left + 8, left + 20):
+            linkmap[top + 2:top + 8, link_left:link_left + 4] = 0.9
+    # blob below text_threshold
+    textmap[60:64, 100:104] = 0.5
+    return textmap, linkmap
+
+
+class TestCraftUtils(unittest.TestCase):
+    def test_get_det_boxes(self):
+        textmap, linkmap = make_score_maps()
+        box_dict = getDetBoxes(textmap, linkmap, 0.7, 0.4, 0.4, poly=True)
+
+        self.assertEqual(box_dict["mapper"], [1, 2])
+        self.assertEqual(box_dict["word_id"], [1, -1])
+        # character components plus the background label
+        self.assertEqual(box_dict["num_characters"], [4, 4])
+        self.assertEqual(box_dict["average_character_size"], [2400.0, 2400.0])
+        np.testing.assert_array_equal(
+            box_dict["boxes"][0], [[17, 17], [54, 17], [54, 32], [17, 32]]
+        )
+        np.testing.assert_array_equal(
+            box_dict["boxes"][1], [[17, 31], [54, 31], [54, 46], [17, 46]]
+        )
+        self.assertEqual(box_dict["polys"][0].shape, (14, 2))
+
+    def test_get_det_boxes_distant_lines(self):
+        textmap, linkmap = make_score_maps(second_line_left=70)
+        box_dict = getDetBoxes(textmap, linkmap, 0.7, 0.4, 0.4)
+
+        self.assertEqual(len(box_dict["boxes"]), 2)
+        self.assertEqual(box_dict["word_id"], [-1, -1])
+        self.assertEqual(box_dict["polys"], [None, None])
+
+    def test_invert_homography(self):
+        rng = np.random.RandomState(0)
+        for _ in range(100):
+            M = rng.normal(size=(3, 3))
+            np.testing.assert_allclose(
+                invertHomography(M), np.linalg.inv(M), rtol=1e-6, atol=1e-9
+            )
+        box = np.float32([[3, 5], [40, 8], [38, 30], [2, 25]])
+        tar = np.float32([[0, 0], [37, 0], [37, 22], [0, 22]])
+        M = cv2.getPerspectiveTransform(box, tar)
+        np.testing.assert_allclose(invertHomography(M), np.linalg.inv(M), rtol=1e-6)
+
+    def test_invert_singular_homography(self):
+        with self.assertRaises(ZeroDivisionError):
+            invertHomography(np.zeros((3, 3)))
+        with self.assertRaises(ZeroDivisionError):
+            invertHomography(np.array([[1.0, 2.0, 3.0], [2.0, 4.0, 6.0], [0.0, 1.0, 1.0]]))
+
+    def test_line_overlaps(self):
+        mask = np.zeros((20, 30), dtype=np.int32)
+        mask[5:8, 10:14] = 1
+        lines = [
+            ((12, 0), (12, 19)),  # crosses the mask
+            ((0, 0), (29, 19)),  # diagonal
+            ((20, 0), (20, 19)),  # misses the mask
+            ((-10, 6), (40, 6)),  # clipped on both ends
+            ((11, -5), (11, 3)),  # clipped, ends above the mask
+            ((-5, -5), (-1, 30)),  # fully left of the mask
+            ((0, 25), (29, 40)),  # fully below the mask
+        ]
+        for pt1, pt2 in lines:
+            line_img = np.zeros(mask.shape, dtype=np.uint8)
+            cv2.line(line_img, pt1, pt2, 1, thickness=1)
+            expected = bool(np.logical_and(mask, line_img).any())
+            self.assertEqual(lineOverlaps(mask, pt1, pt2), expected, (pt1, pt2))
+
+        self.assertTrue(lineOverlaps(mask, (12, 0), (12, 19)))
+        self.assertFalse(lineOverlaps(mask, (-5, -5), (-1, 30)))
+
+
+if __name__ == "__main__":
+    unittest.main()